@@ -2,174 +2,452 @@ import streamlit as st
 import requests
 import json
 import os
-from requests.auth import HTTPBasicAuth
+import io
+import sys
+import base64
+import html
+import hashlib
+from functools import lru_cache
+from operator import itemgetter
+from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
+import numpy as np
+import pyarrow as pa
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+import plotly.io as pio
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+    # Streamlit serializes every chart through plotly.io.to_json
+    pio.json.config.default_engine = "orjson"
+except ImportError:
+    _loads = json.loads
+    
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Malformed JSON, from json/orjson or from the ijson streaming parser
+JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError) if ijson else (json.JSONDecodeError,)
 
 st.set_page_config(page_title="OpenSearch Query Profiler", layout="wide")
 
+# Escapes applied to the body of a triple-quoted description to make it a JSON string
+_TRIPLE_QUOTE_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+
+# Layout shared by the horizontal time bar charts
+_HBAR_LAYOUT = {'xaxis_title': "Time (ms)", 'showlegend': False}
+
+# Multiply by this instead of dividing by 1_000_000 to turn nanoseconds into milliseconds
+NS_TO_MS = 1e-6
+
+# Pasted responses above this size are stream-parsed (needs ijson) instead of loaded whole
+MAX_INLINE_RESPONSE_SIZE = 10_000_000
+
+# Characters of a pasted response encoded per step while hashing it
+HASH_CHUNK_SIZE = 1 << 20
+
+# Process-wide caches serve every user, so they hold a few responses each and let idle ones expire
+RESPONSE_CACHE_ENTRIES = 16
+RESPONSE_CACHE_TTL = "1h"
+
+# Breakdown charts are informational, so they render static without a mode bar
+BREAKDOWN_CHART_CONFIG = {'displayModeBar': False, 'staticPlot': True}
+
+# Shards listed per page in the profile tree
+SHARD_PAGE_SIZE = 20
+
+# Numeric table columns, formatted by the dataframe instead of stored as strings
+TABLE_COLUMN_CONFIG = {
+    'Time (ms)': st.column_config.NumberColumn(format="%.3f"),
+    'Relative %': st.column_config.NumberColumn(format="%.1f%%")
+}
+
+# Time percentage badges and operation descriptions, styled once per page instead of inline on every row
+_BADGE_CSS = """<style>
+.badge { color: white; padding: 4px 8px; border-radius: 4px; text-align: center; font-weight: bold; font-size: 12px; }
+.shard-badge { padding: 8px 16px; border-radius: 8px; font-size: inherit; margin-bottom: 16px; }
+.badge-red { background-color: #ff6b6b; }
+.badge-orange { background-color: #ffa726; }
+.badge-yellow { background-color: #ffeb3b; }
+.badge-green { background-color: #66bb6a; }
+.badge-gray { background-color: #e0e0e0; }
+.op-description { white-space: pre-wrap; margin: 4px 0 0; padding: 4px 8px; font-size: 12px; }
+</style>"""
+
+# Newlines in a description are written as character references so a blank line never ends the HTML table
+_DESCRIPTION_ESCAPES = str.maketrans({'\n': '&#10;', '\r': ''})
+
+# Parts of a search response the profiler reads; everything else (e.g. hits) is skipped when streaming
+_STREAMED_PREFIXES = ("took", "phase_took", "profile.shards.item")
+
+# Password from the environment, read once per run; secrets.toml is only consulted without it
+ENV_PASSWORD = os.getenv('OPENSEARCH_PASSWORD')
+
 def get_password():
-    return os.getenv('OPENSEARCH_PASSWORD') or st.secrets.get("opensearch", {}).get("password")
+    # Streamlit caches secrets.toml itself and reloads it on change, so it is read directly
+    return ENV_PASSWORD or st.secrets.get("opensearch", {}).get("password")
+
+def repair_triple_quotes(text):
+    """Turn triple-quoted description fields into valid JSON strings"""
+    # Single forward scan over the fences; most responses have none and return as is
+    start = text.find('"""')
+    if start == -1:
+        return text
+    
+    parts = []
+    pos = 0
+    while start != -1:
+        end = text.find('"""', start + 3)
+        if end == -1:
+            break
+        
+        # Only repair values of "description" keys, allowing whitespace after the colon
+        key_end = start
+        while key_end > pos and text[key_end - 1] in ' \t\r\n':
+            key_end -= 1
+        if not text.endswith('"description":', pos, key_end):
+            start = text.find('"""', start + 1)
+            continue
+        
+        parts.append(text[pos:key_end])
+        parts.append(' "')
+        parts.append(text[start + 3:end].translate(_TRIPLE_QUOTE_ESCAPES))
+        parts.append('"')
+        pos = end + 3
+        start = text.find('"""', pos)
+    
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+class EncodedTextReader:
+    """Binary file-like view of a str that encodes one chunk per read"""
+    
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+    
+    def read(self, size=-1):
+        end = len(self.text) if size < 0 else self.pos + size
+        chunk = self.text[self.pos:end]
+        self.pos += len(chunk)
+        return chunk.encode()
+
+def stream_profile_response(raw, on_shard=None):
+    """Stream-parse only took, phase_took and the profile shards from a response
+    
+    Returns the result together with the shard model, which is built from each shard
+    as soon as it is parsed rather than in a second walk over the whole profile.
+    on_shard, if given, is called with the running shard count as each shard completes.
+    A str response is encoded chunk by chunk as ijson reads it, never copied whole.
+    """
+    result = {}
+    shards = []
+    shard_models = []
+    op_names = {}
+    builder = None
+    source = EncodedTextReader(raw) if isinstance(raw, str) else io.BytesIO(raw)
+    for prefix, event, value in ijson.parse(source, use_float=True):
+        if builder is None:
+            if prefix == "profile" and event == "start_map":
+                result["profile"] = {"shards": shards}
+            if prefix not in _STREAMED_PREFIXES or event in ("map_key", "end_map", "end_array"):
+                continue
+            builder, target, depth = ijson.ObjectBuilder(), prefix, 0
+        
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        
+        # Value complete, keep it and drop the builder state
+        if depth == 0:
+            if target == "profile.shards.item":
+                shard_models.append(parse_shard(len(shards), builder.value, op_names))
+                shards.append(builder.value)
+                if on_shard is not None:
+                    on_shard(len(shards))
+            else:
+                result[target] = builder.value
+            builder = None
+    return result, shard_models
+
+def profile_key(raw):
+    """Content fingerprint used to key cached work on a profile response"""
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(raw, str):
+        # Encode a chunk at a time, like EncodedTextReader, so a huge paste is never copied whole
+        for start in range(0, len(raw), HASH_CHUNK_SIZE):
+            digest.update(raw[start:start + HASH_CHUNK_SIZE].encode())
+    else:
+        digest.update(raw)
+    return digest.hexdigest()
+
+def get_session():
+    """Per-user HTTP session so repeat queries reuse pooled TLS connections"""
+    # Kept in session state rather than as a shared resource, so cookies set by one
+    # user's cluster and the connection pool are never shared with other users
+    session = st.session_state.get('_http_session')
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=3)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        st.session_state._http_session = session
+    return session
+
+def parse_query(query):
+    """Parse the query text, reusing the last result while the text is unchanged"""
+    if st.session_state.get('_query_text') != query:
+        st.session_state._query_dict = _loads(query)
+        st.session_state._query_text = query
+    return dict(st.session_state._query_dict)
+
+def auth_headers(username, password):
+    """Request headers with a Basic Authorization value computed once per credential pair"""
+    cached = st.session_state.get('_auth_headers')
+    if cached is None or cached[0] != (username, password):
+        token = base64.b64encode(f"{username}:{password}".encode()).decode()
+        headers = {"Authorization": f"Basic {token}", "Content-Type": "application/json"}
+        cached = st.session_state._auth_headers = ((username, password), headers)
+    return cached[1]
 
 def execute_query(endpoint, index, query, username, password):
-    query_dict = json.loads(query)
+    query_dict = parse_query(query)
     query_dict["profile"] = True
     
     endpoint = endpoint.rstrip('/')
     url = f"{endpoint}/{index}/_search?phase_took=true"
     
     try:
-        response = requests.post(url, json=query_dict, auth=HTTPBasicAuth(username, password))
+        response = get_session().post(url, data=_dumps(query_dict), headers=auth_headers(username, password), timeout=(3, 60))
         if response.status_code != 200:
             st.error(f"HTTP {response.status_code}: {response.text}")
-            return None
-        return response.json()
+            return None, None
+        return _loads(response.content), profile_key(response.content)
     except Exception as e:
         st.error(f"Error: {e}")
-        return None
+        return None, None
 
-def parse_profile(profile_data):
-    shards = []
-    for i, shard in enumerate(profile_data.get("shards", [])):
-        shard_data = {
-            "id": shard.get("id", f"shard_{i}"),
-            "index": shard.get("id", "").split("[")[0] if "[" in shard.get("id", "") else "unknown",
-            "searches": [],
-            "aggregations": []
-        }
-        
-        for search in shard.get("searches", []):
-            search_data = {"queries": [], "collectors": []}
-            
-            for query in search.get("query", []):
-                query_data = {
-                    "type": query.get("type", "unknown"),
-                    "description": query.get("description", ""),
-                    "time_ms": query.get("time_in_nanos", 0) / 1_000_000,
-                    "breakdown": [{"operation": op, "time_ms": time_ns / 1_000_000} 
-                                 for op, time_ns in query.get("breakdown", {}).items()]
-                }
-                search_data["queries"].append(query_data)
-            
-            for collector in search.get("collector", []):
-                collector_data = {
-                    "name": collector.get("name", "unknown"),
-                    "reason": collector.get("reason", ""),
-                    "time_ms": collector.get("time_in_nanos", 0) / 1_000_000,
-                    "children": []
-                }
-                
-                # Process child collectors
-                for child in collector.get("children", []):
-                    child_data = {
-                        "name": child.get("name", "unknown"),
-                        "reason": child.get("reason", ""),
-                        "time_ms": child.get("time_in_nanos", 0) / 1_000_000
-                    }
-                    collector_data["children"].append(child_data)
-                
-                search_data["collectors"].append(collector_data)
-            
-            shard_data["searches"].append(search_data)
+def fill_breakdown_times(pending):
+    """Convert all (parsed, raw) breakdown pairs of a shard to ms in one numpy pass"""
+    sizes = [len(raw) for _, raw in pending]
+    nanos = np.fromiter((ns for _, raw in pending for ns in raw.values()),
+                        dtype=np.int64, count=sum(sizes))
+    times_ms = nanos * NS_TO_MS
+    
+    # Each breakdown gets a view onto its slice of the shard array
+    start = 0
+    for (breakdown, _), size in zip(pending, sizes):
+        breakdown["times_ms"] = times_ms[start:start + size]
+        start += size
+
+def shared_op_names(breakdown, op_names):
+    """Interned op-name tuple for a breakdown, shared by every breakdown with the same keys"""
+    keys = tuple(breakdown)
+    ops = op_names.get(keys)
+    if ops is None:
+        ops = op_names[keys] = tuple(sys.intern(op) for op in keys)
+    return ops
+
+def parse_shard(i, shard, op_names):
+    """Build the shard model for the i-th raw profile shard
+    
+    op_names is shared across the shards of a profile, which mostly run the same
+    queries and so repeat the same breakdown key sets.
+    """
+    # Local bindings keep the per-node work to plain local lookups on large profiles
+    _get = dict.get
+    inv_ns = NS_TO_MS
+    raw_id = _get(shard, "id", "")
+    shard_data = {
+        "id": _get(shard, "id", f"shard_{i}"),
+        "index": raw_id.split("[")[0] if "[" in raw_id else "unknown",
+        "searches": [],
+        "aggregations": []
+    }
+    # Breakdowns awaiting their times_ms, converted together per shard
+    pending = []
+    
+    for search in _get(shard, "searches", []):
+        queries = []
+        for query in _get(search, "query", []):
+            raw_breakdown = _get(query, "breakdown", {})
+            breakdown = {"ops": shared_op_names(raw_breakdown, op_names)}
+            pending.append((breakdown, raw_breakdown))
+            queries.append({
+                "type": _get(query, "type", "unknown"),
+                "description": _get(query, "description", ""),
+                "time_ms": _get(query, "time_in_nanos", 0) * inv_ns,
+                "breakdown": breakdown
+            })
         
-        for agg in shard.get("aggregations", []):
-            agg_data = {
-                "type": agg.get("type", "unknown"),
-                "description": agg.get("description", ""),
-                "time_ms": agg.get("time_in_nanos", 0) / 1_000_000,
-                "breakdown": [{"operation": op, "time_ms": time_ns / 1_000_000} 
-                             for op, time_ns in agg.get("breakdown", {}).items()]
-            }
-            shard_data["aggregations"].append(agg_data)
+        collectors = [{
+            "name": _get(collector, "name", "unknown"),
+            "reason": _get(collector, "reason", ""),
+            "time_ms": _get(collector, "time_in_nanos", 0) * inv_ns,
+            # Child collectors
+            "children": [{
+                "name": _get(child, "name", "unknown"),
+                "reason": _get(child, "reason", ""),
+                "time_ms": _get(child, "time_in_nanos", 0) * inv_ns
+            } for child in _get(collector, "children", [])]
+        } for collector in _get(search, "collector", [])]
         
-        shards.append(shard_data)
-    return shards
-
-def create_shard_chart(shards):
-    if not shards:
-        return None
+        shard_data["searches"].append({"queries": queries, "collectors": collectors})
     
-    shard_data = []
-    for s in shards:
-        shard_time = sum(q['time_ms'] for search in s['searches'] for q in search['queries'])
-        shard_data.append({'name': f"{s['index']}[{s['id']}]", 'time': shard_time})
+    for agg in _get(shard, "aggregations", []):
+        raw_breakdown = _get(agg, "breakdown", {})
+        breakdown = {"ops": shared_op_names(raw_breakdown, op_names)}
+        pending.append((breakdown, raw_breakdown))
+        shard_data["aggregations"].append({
+            "type": _get(agg, "type", "unknown"),
+            "description": _get(agg, "description", ""),
+            "time_ms": _get(agg, "time_in_nanos", 0) * inv_ns,
+            "breakdown": breakdown
+        })
     
-    shard_data.sort(key=lambda x: x['time'], reverse=True)
-    top_shards = shard_data[:10]
+    # Total query time is used for sorting, charting and percentages, so compute it once
+    shard_data["total_query_ms"] = sum(q["time_ms"] for search in shard_data["searches"] for q in search["queries"])
+    fill_breakdown_times(pending)
+    return shard_data
+
+def parse_profile(profile_data):
+    op_names = {}
+    return [parse_shard(i, shard, op_names) for i, shard in enumerate(profile_data.get("shards", []))]
+
+def top_k_indices(times, k):
+    """Indices of the k largest times, slowest first, without a full sort"""
+    k = min(k, len(times))
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(times, -k)[-k:]
+    return top[np.argsort(-times[top], kind='stable')]
+
+@lru_cache(maxsize=256)
+def pretty_op(op):
+    """Display label for a breakdown operation name, e.g. build_scorer -> Build Scorer"""
+    # Operation names are a small closed set, so every later row is a cache hit
+    return op.replace('_', ' ').title()
+
+def hbar_layout(title, height, **extra):
+    """Layout for a horizontal time bar chart, passed straight to go.Figure"""
+    return {**_HBAR_LAYOUT, 'title': title, 'height': height, 'uirevision': title, **extra}
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def create_shard_chart(shard_times):
+    """Create shard chart from a tuple of (shard name, time) pairs, slowest first"""
+    if not shard_times:
+        return None
     
-    shard_names = [s['name'] for s in reversed(top_shards)]
-    shard_times = [s['time'] for s in reversed(top_shards)]
+    # Slowest at the top of the chart
+    shard_names = [name for name, _ in reversed(shard_times)]
+    shard_times = [time_ms for _, time_ms in reversed(shard_times)]
     
-    fig = go.Figure(go.Bar(y=shard_names, x=shard_times, orientation='h', 
-                          marker_color=shard_times, marker_colorscale='Viridis'))
-    fig.update_layout(title="Slowest Shards", xaxis_title="Time (ms)", height=300)
-    return fig
+    return go.Figure(go.Bar(y=shard_names, x=shard_times, orientation='h', 
+                            marker_color=shard_times, marker_colorscale='Viridis'),
+                     layout=hbar_layout("Slowest Shards", 300))
 
-def create_breakdown_chart(breakdown_data, title):
-    if not breakdown_data:
+@st.cache_resource(show_spinner=False, max_entries=1024)
+def create_breakdown_chart(breakdown, title):
+    """Create breakdown chart from parallel ops / times_ms arrays"""
+    times_ms = breakdown["times_ms"]
+    if len(times_ms) <= 1:
         return None
     
-    ops = [item["operation"] for item in breakdown_data[:10]]
-    times = [item["time_ms"] for item in breakdown_data[:10]]
+    # Slowest first, dropping zero time operations
+    nonzero = np.flatnonzero(times_ms > 0)
+    if len(nonzero) <= 1:
+        return None
+    order = nonzero[top_k_indices(times_ms[nonzero], 8)]
     
-    fig = go.Figure(go.Bar(y=ops, x=times, orientation='h', 
-                          marker_color=times, marker_colorscale='Plasma'))
-    fig.update_layout(title=title, xaxis_title="Time (ms)", height=400)
-    return fig
+    ops = [pretty_op(breakdown["ops"][i]) for i in order]
+    times = times_ms[order]
+    
+    return go.Figure(go.Bar(
+        y=ops[::-1], 
+        x=times[::-1], 
+        orientation='h',
+        marker_color=times[::-1], 
+        marker_colorscale='Viridis'
+    ), layout=hbar_layout(title, max(200, len(ops) * 30)))
 
-def get_all_components(shards):
-    components = []
+def get_all_components(shards, limit=None):
+    # Parallel columns: (shard, type, name) labels and a float time array
+    labels = []
+    times = []
     for shard in shards:
         shard_name = f"{shard['index']}[{shard['id']}]"
         
         for search in shard['searches']:
             for query in search['queries']:
-                components.append({
-                    "shard": shard_name,
-                    "type": "Query",
-                    "name": query['type'],
-                    "time_ms": query['time_ms']
-                })
+                labels.append((shard_name, "Query", query['type']))
+                times.append(query['time_ms'])
             
             for collector in search['collectors']:
-                components.append({
-                    "shard": shard_name,
-                    "type": "Collector",
-                    "name": collector['name'],
-                    "time_ms": collector['time_ms']
-                })
+                labels.append((shard_name, "Collector", collector['name']))
+                times.append(collector['time_ms'])
         
         for agg in shard['aggregations']:
-            components.append({
-                "shard": shard_name,
-                "type": "Aggregation",
-                "name": agg['type'],
-                "time_ms": agg['time_ms']
-            })
+            labels.append((shard_name, "Aggregation", agg['type']))
+            times.append(agg['time_ms'])
     
-    return sorted(components, key=lambda x: x['time_ms'], reverse=True)
+    # Only the slowest few are charted, so partition instead of sorting every component
+    times = np.asarray(times, dtype=np.float64)
+    order = top_k_indices(times, limit if limit is not None else len(times))
+    
+    return [{
+        "shard": labels[i][0],
+        "type": labels[i][1],
+        "name": labels[i][2],
+        "time_ms": float(times[i])
+    } for i in order]
+
+@st.cache_data(show_spinner=False, max_entries=RESPONSE_CACHE_ENTRIES, ttl=RESPONSE_CACHE_TTL)
+def load_shards(result_key, _profile_data):
+    """Cached parse_profile per response"""
+    return parse_profile(_profile_data)
+
+def store_shards(result_key, shards):
+    """Keep a response's shard model in session state, with its slowest-first order"""
+    st.session_state.shards = shards
+    # Sorted once per response for both the shard chart and the tree
+    st.session_state.shards_by_time = sorted(shards, key=itemgetter('total_query_ms'), reverse=True)
+    st.session_state.shards_key = result_key
 
-def create_phase_chart(phase_took):
-    if not phase_took:
+@st.cache_data(show_spinner=False, max_entries=RESPONSE_CACHE_ENTRIES, ttl=RESPONSE_CACHE_TTL)
+def load_components(result_key, _shards, limit=10):
+    """Cached get_all_components per response"""
+    return get_all_components(_shards, limit)
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def create_phase_chart(phase_items):
+    """Create phase chart from a tuple of (phase, time) pairs"""
+    if not phase_items:
         return None
     
-    all_phases = ["dfs_pre_query", "query", "fetch", "dfs_query", "expand", "can_match"]
-    phases = []
-    times = []
-    
-    for phase in all_phases:
-        phases.append(phase)
-        times.append(phase_took.get(phase, 0))
+    phase_took = dict(phase_items)
+    phases = ["dfs_pre_query", "query", "fetch", "dfs_query", "expand", "can_match"]
+    times = np.fromiter((phase_took.get(phase, 0) for phase in phases), dtype=np.float64, count=len(phases))
     
-    fig = go.Figure(go.Bar(y=phases, x=times, orientation='h',
-                          marker_color=times, marker_colorscale='Blues'))
-    fig.update_layout(title="Query Phases", xaxis_title="Time (ms)", yaxis_title="Phase", height=200)
-    return fig
+    return go.Figure(go.Bar(y=phases, x=times, orientation='h',
+                            marker_color=times, marker_colorscale='Blues'),
+                     layout=hbar_layout("Query Phases", 200, yaxis_title="Phase"))
 
 st.title("🔍 OpenSearch Query Profiler")
 
 # Show overall query time if available
-if hasattr(st.session_state, 'result') and 'took' in st.session_state.result:
-    st.metric("Overall Query Time", f"{st.session_state.result['took']}ms")
+result = st.session_state.get('result')
+if result is not None and 'took' in result:
+    st.metric("Overall Query Time", f"{result['took']}ms")
 
 with st.sidebar:
     st.image("https://opensearch.org/assets/brand/SVG/Logo/opensearch_logo_default.svg", width=150)
@@ -212,16 +490,16 @@ with st.sidebar:
     
     # Handle Execute button
     if execute_clicked:
-        if 'result' in st.session_state:
-            del st.session_state.result
+        st.session_state.pop('result', None)
         
         password = password_input or get_password()
         if password:
             with st.spinner("Executing query..."):
                 try:
-                    result = execute_query(endpoint, index, query, username, password)
+                    result, result_key = execute_query(endpoint, index, query, username, password)
                     if result:
                         st.session_state.result = result
+                        st.session_state.result_key = result_key
                         st.session_state.source = "execute"
                         st.success("Query executed successfully!")
                         st.rerun()
@@ -234,67 +512,84 @@ with st.sidebar:
     
     # Handle Analyze Profile button
     if analyze_clicked:
-        if 'result' in st.session_state:
-            del st.session_state.result
+        st.session_state.pop('result', None)
             
         if profile_response.strip():
             response_size = len(profile_response)
-            if response_size > 10_000_000:
-                st.error("Profile response too large (>10MB). Please use a smaller response.")
+            if response_size > MAX_INLINE_RESPONSE_SIZE and ijson is None:
+                st.error("Profile response too large (>10MB). Please use a smaller response or install ijson.")
             else:
-                with st.spinner(f"Analyzing profile response ({response_size:,} characters)..."):
+                with st.status(f"Analyzing profile response ({response_size:,} characters)...", expanded=False) as status:
                     try:
-                        import re
+                        # Fix triple quotes in description fields; most responses have none
                         cleaned_response = profile_response
+                        if '"""' in profile_response:
+                            status.update(label="Repairing JSON...")
+                            cleaned_response = repair_triple_quotes(profile_response)
                         
-                        # Fix triple quotes in description fields
-                        def fix_description(match):
-                            content = match.group(1)
-                            # Escape quotes but preserve the full content
-                            content = content.replace('"', '\\"')
-                            return '"description": "' + content + '"'
-                        
-                        cleaned_response = re.sub(
-                            r'"description":\s*"""(.*?)"""',
-                            fix_description,
-                            cleaned_response,
-                            flags=re.DOTALL
-                        )
-                        
-                        result = json.loads(cleaned_response)
+                        status.update(label="Parsing JSON...")
+                        result_key = profile_key(profile_response)
+                        if response_size > MAX_INLINE_RESPONSE_SIZE:
+                            # Count shards as they stream so the large-profile warning shows before parsing ends
+                            def on_shard(count):
+                                if count == 101:
+                                    status.update(expanded=True)
+                                    st.warning("Large profile with over 100 shards. Processing may take time...")
+                                if count % 100 == 0:
+                                    status.update(label=f"Parsing JSON... ({count:,} shards so far)")
+                            
+                            # Avoid materializing hits and other unused parts of huge responses
+                            result, shard_models = stream_profile_response(cleaned_response, on_shard)
+                        else:
+                            result, shard_models = _loads(cleaned_response), None
                         if "profile" in result:
                             profile_shards = len(result["profile"].get("shards", []))
-                            if profile_shards > 100:
+                            if profile_shards > 100 and response_size <= MAX_INLINE_RESPONSE_SIZE:
                                 st.warning(f"Large profile with {profile_shards} shards. Processing may take time...")
                             
+                            # Warm the shard model here so the rerun below only renders
+                            if shard_models is None:
+                                status.update(label=f"Building shard model ({profile_shards} shards)...")
+                                shard_models = load_shards(result_key, result["profile"])
+                            store_shards(result_key, shard_models)
+                            
                             st.session_state.result = result
+                            st.session_state.result_key = result_key
                             st.session_state.source = "analyze"
-                            st.success(f"Profile loaded successfully! ({profile_shards} shards)")
+                            status.update(label=f"Profile loaded successfully! ({profile_shards} shards)", state="complete")
                             st.rerun()
                         else:
+                            status.update(label="No profile data found in response", state="error", expanded=True)
                             st.error("No profile data found in response")
-                    except json.JSONDecodeError as e:
+                    except JSON_ERRORS as e:
+                        status.update(label="JSON parsing failed", state="error", expanded=True)
                         st.error(f"JSON parsing failed: {str(e)[:200]}...")
                         st.info("The profile response contains invalid JSON. Try copying the response again.")
                     except Exception as e:
+                        status.update(label="Analysis error", state="error", expanded=True)
                         st.error(f"Analysis error: {str(e)[:200]}...")
         else:
             st.error("Please provide a profile response")
 
-if hasattr(st.session_state, 'result'):
-    result = st.session_state.result
+result = st.session_state.get('result')
+if result is not None:
     
     if "profile" not in result:
         st.error("No profile data in response")
         st.json(result)
         st.stop()
     
-    shards = parse_profile(result["profile"])
+    # Parsed shards live in session state so hot reruns skip even the cache lookup
+    result_key = st.session_state.get('result_key')
+    if st.session_state.get('shards_key') != result_key or 'shards' not in st.session_state:
+        store_shards(result_key, load_shards(result_key, result["profile"]))
+    shards = st.session_state.shards
+    shards_by_time = st.session_state.shards_by_time
     
     # Phase timing overview
-    if "phase_took" in st.session_state.result:
+    if "phase_took" in result:
         st.subheader("⏱️ Query & Fetch Phases")
-        phase_took = st.session_state.result["phase_took"]
+        phase_took = result["phase_took"]
         
         col1, col2, col3, col4 = st.columns(4)
         with col1:
@@ -306,355 +601,424 @@ if hasattr(st.session_state, 'result'):
         with col4:
             st.metric("Can Match", f"{phase_took.get('can_match', 0)}ms")
         
-        phase_fig = create_phase_chart(phase_took)
+        phase_fig = create_phase_chart(tuple(phase_took.items()))
         if phase_fig:
-            st.plotly_chart(phase_fig, use_container_width=True, config={'displayModeBar': True})
+            st.plotly_chart(phase_fig, use_container_width=True, config={'displayModeBar': True}, key="phase_chart")
     
     # Shard level overview
     st.subheader("Shard Overview")
-    shard_fig = create_shard_chart(shards)
+    shard_fig = create_shard_chart(tuple(
+        (f"{s['index']}[{s['id']}]", s['total_query_ms'])
+        for s in shards_by_time[:10]
+    ))
     if shard_fig:
-        st.plotly_chart(shard_fig, use_container_width=True, config={'displayModeBar': True})
+        st.plotly_chart(shard_fig, use_container_width=True, config={'displayModeBar': True}, key="shard_chart")
     
     # Top slowest components
-    all_components = get_all_components(shards)
-    if all_components:
+    top_components = load_components(result_key, shards)
+    if top_components:
         st.subheader("🐌 Slowest Components")
-        top_components = all_components[:10]
         
         comp_names = [f"{c['type']}: {c['name']}" for c in top_components]
         comp_times = [c['time_ms'] for c in top_components]
         
         fig = go.Figure(go.Bar(y=comp_names, x=comp_times, orientation='h', 
-                              marker_color=comp_times, marker_colorscale='Reds'))
-        fig.update_layout(title="Top 10 Slowest Components", xaxis_title="Time (ms)", height=400)
-        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': True})
+                               marker_color=comp_times, marker_colorscale='Reds'),
+                        layout=hbar_layout("Top 10 Slowest Components", 400))
+        st.plotly_chart(fig, use_container_width=True, config={'displayModeBar': True}, key="components_chart")
     
 
 
 
-def build_operation_tree(query_data, parent_time=None):
-    """Build hierarchical operation tree"""
-    operations = []
+def flatten_operation_tree(query_data):
+    """Raw query nodes in depth-first order, with each node's parent index (-1 for roots)"""
+    nodes = []
+    parents = []
+    stack = [(query_data, -1)]
+    while stack:
+        node, parent = stack.pop()
+        if isinstance(node, list):
+            stack.extend((item, parent) for item in reversed(node))
+        elif isinstance(node, dict):
+            parents.append(parent)
+            children = node.get('children')
+            if children:
+                stack.append((children, len(nodes)))
+            nodes.append(node)
+    return nodes, np.array(parents, dtype=np.intp)
+
+def build_operation_tree(query_data):
+    """Build hierarchical operation tree
     
-    if isinstance(query_data, list):
-        for item in query_data:
-            operations.extend(build_operation_tree(item, parent_time))
-    elif isinstance(query_data, dict):
-        time_ns = query_data.get('time_in_nanos', 0)
-        time_ms = time_ns / 1_000_000
-        
+    Times, parent percentages and self times are computed over the flattened
+    tree as whole arrays, then the nested operations are reassembled from them.
+    """
+    nodes, parents = flatten_operation_tree(query_data)
+    if not nodes:
+        return []
+    
+    times_ns = np.fromiter((node.get('time_in_nanos', 0) for node in nodes), dtype=np.int64, count=len(nodes))
+    times_ms = times_ns * NS_TO_MS
+    has_parent = parents >= 0
+    
+    # Percentage of parent time, 100 for roots and zero time parents
+    parent_ms = np.where(has_parent, times_ms[parents], 0.0)
+    percentages = np.full(len(nodes), 100.0)
+    np.divide(times_ms * 100, parent_ms, out=percentages, where=parent_ms > 0)
+    
+    # Self time is total time minus the summed time of direct children
+    children_ms = np.bincount(parents[has_parent], weights=times_ms[has_parent], minlength=len(nodes))
+    self_ms = times_ms - children_ms
+    
+    operations = []
+    built = []
+    for node, parent, time_ns, time_ms, percentage, self_time in zip(
+            nodes, parents.tolist(), times_ns.tolist(), times_ms.tolist(), percentages.tolist(), self_ms.tolist()):
+        _get = node.get
         operation = {
-            'type': query_data.get('type', 'Unknown'),
-            'description': query_data.get('description', ''),
+            'type': _get('type', 'Unknown'),
+            'description': _get('description', ''),
             'time_ms': time_ms,
             'time_ns': time_ns,
-            'breakdown': query_data.get('breakdown', {}),
+            'self_time_ms': self_time,
+            'percentage': percentage,
+            'breakdown': _get('breakdown', {}),
             'children': []
         }
-        
-        # Calculate percentage of parent time
-        if parent_time and parent_time > 0:
-            operation['percentage'] = (time_ms / parent_time) * 100
-        else:
-            operation['percentage'] = 100
-            
-        # Process children recursively
-        if 'children' in query_data and query_data['children']:
-            operation['children'] = build_operation_tree(query_data['children'], time_ms)
-        
-        operations.append(operation)
+        # Parents always precede their children in depth-first order
+        (operations if parent < 0 else built[parent]['children']).append(operation)
+        built.append(operation)
     
     return operations
 
-def calculate_self_time(operation):
-    """Calculate self time (total time - children time)"""
-    children_time = sum(child['time_ms'] for child in operation.get('children', []))
-    return operation['time_ms'] - children_time
+@st.cache_data(show_spinner=False, max_entries=256, ttl=RESPONSE_CACHE_TTL)
+def load_operation_tree(result_key, shard_id, search_idx, _query_data):
+    """Cached build_operation_tree per shard search"""
+    return build_operation_tree(_query_data)
 
-def get_color_for_percentage(percentage):
-    """Get color based on time percentage"""
+def get_badge_class(percentage):
+    """Get badge CSS class based on time percentage"""
     if percentage >= 80:
-        return "#ff6b6b"  # Red
+        return "badge-red"
     elif percentage >= 60:
-        return "#ffa726"  # Orange  
+        return "badge-orange"
     elif percentage >= 40:
-        return "#ffeb3b"  # Yellow
+        return "badge-yellow"
     elif percentage >= 20:
-        return "#66bb6a"  # Light Green
+        return "badge-green"
     else:
-        return "#e0e0e0"  # Gray
+        return "badge-gray"
 
-def create_breakdown_chart_from_list(breakdown_list, title):
-    """Create breakdown chart from list format"""
-    if not breakdown_list or len(breakdown_list) <= 1:
-        return None
-    
-    # Filter out zero time operations and sort by time
-    filtered_breakdown = [item for item in breakdown_list if item.get('time_ms', 0) > 0]
-    filtered_breakdown.sort(key=lambda x: x.get('time_ms', 0), reverse=True)
-    
-    if len(filtered_breakdown) <= 1:
-        return None
-    
-    ops = [item.get('operation', '').replace('_', ' ').title() for item in filtered_breakdown[:8]]
-    times = [item.get('time_ms', 0) for item in filtered_breakdown[:8]]
-    
-    fig = go.Figure(go.Bar(
-        y=ops[::-1], 
-        x=times[::-1], 
-        orientation='h',
-        marker_color=times[::-1], 
-        marker_colorscale='Viridis'
-    ))
-    fig.update_layout(
-        title=title, 
-        xaxis_title="Time (ms)", 
-        height=max(200, len(ops) * 30),
-        showlegend=False
-    )
-    return fig
+def breakdown_timings(breakdown):
+    """Op names and raw values of a breakdown dict's timings, skipping counts and non-numeric entries"""
+    keys = np.array(list(breakdown), dtype=str)
+    values = np.fromiter((value if isinstance(value, (int, float)) else np.nan for value in breakdown.values()),
+                         dtype=np.float64, count=len(keys))
+    timing = ~np.char.endswith(keys, '_count') & ~np.isnan(values)
+    return keys[timing], values[timing]
 
-def create_breakdown_chart_from_dict(breakdown_dict, title):
-    """Create breakdown chart from dict format"""
-    if not breakdown_dict:
-        return None
+def slowest_first(values):
+    """Indices of the positive values, slowest first"""
+    positive = np.flatnonzero(values > 0)
+    return positive[np.argsort(-values[positive], kind='stable')]
+
+def build_breakdown_tables(shard):
+    """Aggregation breakdown (slowest first) and child collector tables of a shard
     
-    breakdown_data = []
-    for key, value in breakdown_dict.items():
-        if not key.endswith('_count') and isinstance(value, (int, float)) and value > 0:
-            time_ms = value / 1_000_000 if value > 1000 else value
-            breakdown_data.append({
-                'operation': key,
-                'time_ms': time_ms
+    Tables are Arrow tables with numeric times, formatted for display by
+    TABLE_COLUMN_CONFIG rather than turned into strings. Building them as Arrow
+    once lets st.dataframe serialize them directly on every rerun.
+    """
+    aggregations = {}
+    for agg_idx, agg in enumerate(shard['aggregations']):
+        # Breakdowns are normalized to parallel ops / times_ms at parse time
+        ops, times_ms = agg['breakdown']['ops'], agg['breakdown']['times_ms']
+        order = slowest_first(times_ms)
+        if len(order):
+            aggregations[agg_idx] = pa.table({
+                'Operation': [pretty_op(ops[i]) for i in order.tolist()],
+                'Time (ms)': times_ms[order]
             })
     
-    return create_breakdown_chart_from_list(breakdown_data, title)
+    # One row per top level collector, with its child table (or None) at the same position
+    collectors = {'Collector': [], 'Reason': [], 'Time (ms)': [], 'Children': []}
+    collector_children = []
+    for search in shard['searches']:
+        for collector in search.get('collectors', []):
+            children = collector.get('children', [])
+            collectors['Collector'].append(collector['name'])
+            collectors['Reason'].append(collector.get('reason', ''))
+            collectors['Time (ms)'].append(collector['time_ms'])
+            collectors['Children'].append(len(children))
+            collector_children.append(pa.table({
+                'Name': [child['name'] for child in children],
+                'Reason': [child.get('reason', '') for child in children],
+                'Time (ms)': [child['time_ms'] for child in children]
+            }) if children else None)
+    
+    return {
+        'aggregations': aggregations,
+        'collector_names': collectors['Collector'],
+        'collectors': pa.table(collectors),
+        'collector_children': collector_children
+    }
+
+@st.cache_data(show_spinner=False, max_entries=256, ttl=RESPONSE_CACHE_TTL)
+def load_breakdown_tables(result_key, shard_id, _shard):
+    """Cached build_breakdown_tables per shard"""
+    return build_breakdown_tables(_shard)
 
+@st.cache_resource(show_spinner=False, max_entries=1024)
 def create_collector_chart(collector_data, title):
     """Create chart for collector data"""
     if not collector_data or len(collector_data) <= 1:
         return None
     
     # Sort by time
-    sorted_collectors = sorted(collector_data, key=lambda x: x.get('time_ms', 0), reverse=True)
+    sorted_collectors = sorted(collector_data, key=itemgetter('time_ms'), reverse=True)
     
     names = [item['name'] for item in sorted_collectors[:10]]
     times = [item['time_ms'] for item in sorted_collectors[:10]]
     
-    fig = go.Figure(go.Bar(
+    return go.Figure(go.Bar(
         y=names[::-1], 
         x=times[::-1], 
         orientation='h',
         marker_color=times[::-1], 
         marker_colorscale='Oranges'
-    ))
-    fig.update_layout(
-        title=title, 
-        xaxis_title="Time (ms)", 
-        height=max(200, len(names) * 30),
-        showlegend=False
+    ), layout=hbar_layout(title, max(200, len(names) * 30)))
+
+@st.cache_resource(show_spinner=False, max_entries=1024)
+def create_query_breakdown_chart(charts):
+    """One figure with a subplot per (title, ops, times) query breakdown, slowest first"""
+    row_heights = [max(150, len(ops) * 30) for _, ops, _ in charts]
+    height = sum(row_heights) + 60 * len(charts)
+    fig = make_subplots(
+        rows=len(charts), cols=1,
+        subplot_titles=[title for title, _, _ in charts],
+        row_heights=row_heights,
+        vertical_spacing=60 / height
     )
+    for row, (_, ops, times) in enumerate(charts, start=1):
+        fig.add_trace(go.Bar(
+            y=ops[::-1], 
+            x=times[::-1], 
+            orientation='h',
+            marker_color=times[::-1], 
+            marker_colorscale='Viridis'
+        ), row=row, col=1)
+    fig.update_xaxes(title_text="Time (ms)", row=len(charts), col=1)
+    fig.update_layout(height=height, showlegend=False)
     return fig
 
-def display_operation_tree(operations, level=0, total_time=None, unique_prefix=""):
-    """Display operations in a tree structure"""
-    for i, op in enumerate(operations):
+@dataclass(frozen=True)
+class ChartLabel:
+    """Identifies a profile tree chart within the current response"""
+    kind: str
+    key: tuple
+    title: str
+
+def memo_chart(label, build, *args):
+    """Reuse the figure built for an equal label earlier in this session
+    
+    The shared figure caches hash a chart's data on every call, so the tree's
+    charts are also kept per session and looked up by their small label on reruns.
+    """
+    result_key = st.session_state.get('result_key')
+    cached_key, figs = st.session_state.get('_fig_cache', (None, None))
+    if cached_key != result_key:
+        figs = {}
+        st.session_state._fig_cache = (result_key, figs)
+    if label not in figs:
+        figs[label] = build(*args)
+    return figs[label]
+
+def display_operation_tree(operations, total_time=None, unique_prefix=""):
+    """Display operations in a tree structure
+    
+    The tree is walked iteratively and every row goes out in a single HTML table, so a
+    large query costs one markdown element instead of several widgets per node.
+    """
+    rows = io.StringIO()
+    breakdown_table = {'Query': [], 'Operation': [], 'Time (ms)': [], 'Relative %': []}
+    charts = []
+    
+    # Depth-first, in document order
+    stack = [(op, 0) for op in reversed(operations)]
+    while stack:
+        op, level = stack.pop()
+        
         # Calculate percentage relative to total query time
         if total_time and total_time > 0:
             total_percentage = (op['time_ms'] / total_time) * 100
         else:
             total_percentage = op['percentage']
-            
-        self_time = calculate_self_time(op)
-        color = get_color_for_percentage(total_percentage)
         
-        # Create indentation for tree structure
-        indent_spaces = "　" * level
+        self_time = op['self_time_ms']
+        badge_class = get_badge_class(total_percentage)
         tree_symbol = "├─ " if level > 0 else "🔍 "
         
-        # Operation header container
-        with st.container():
-            # Operation header with timing info
-            col1, col2, col3, col4 = st.columns([3, 1, 1, 1])
-            
-            with col1:
-                # Operation name with tree structure
-                st.markdown(f"**{indent_spaces}{tree_symbol}{op['type']}**")
-                if op['description'] and level < 3:  # Only show description for top levels
-                    with st.container():
-                        st.code(op['description'], language='text')
-            
-            with col2:
-                st.metric("Self Time", f"{self_time:.2f}ms")
-            
-            with col3:
-                st.metric("Total Time", f"{op['time_ms']:.2f}ms")
-                
-            with col4:
-                # Color-coded percentage badge
-                st.markdown(f"""
-                <div style="
-                    background-color: {color}; 
-                    color: white; 
-                    padding: 4px 8px; 
-                    border-radius: 4px; 
-                    text-align: center; 
-                    font-weight: bold;
-                    font-size: 12px;
-                ">
-                    {total_percentage:.1f}%
-                </div>
-                """, unsafe_allow_html=True)
+        # Only show description for top levels
+        description = ""
+        if op['description'] and level < 3:
+            description = f'<pre class="op-description">{html.escape(op["description"]).translate(_DESCRIPTION_ESCAPES)}</pre>'
+        
+        rows.write(
+            f'<tr><td style="padding-left: {level * 1.5 + 0.5}em;">'
+            f'<b>{tree_symbol}{html.escape(op["type"])}</b>{description}</td>'
+            f'<td>{self_time:.2f}ms</td><td>{op["time_ms"]:.2f}ms</td>'
+            f'<td><div class="badge {badge_class}">{total_percentage:.1f}%</div></td></tr>'
+        )
+        
+        # Collect breakdowns of the top levels for one chart each and a shared table
+        if op['breakdown'] and isinstance(op['breakdown'], dict) and level < 2:
+            keys, values = breakdown_timings(op['breakdown'])
+            order = slowest_first(values)
             
-            # Show breakdown if available and at top levels
-            if op['breakdown'] and isinstance(op['breakdown'], dict) and level < 2:
-                breakdown_data = []
-                total_breakdown_time = sum(v for k, v in op['breakdown'].items() if not k.endswith('_count') and isinstance(v, (int, float)))
+            if len(order) > 1:
+                total_breakdown_time = values.sum()
+                values = values[order]
+                times_ms = values * NS_TO_MS
+                relative_pcts = values / total_breakdown_time * 100
+                ops = [pretty_op(key) for key in keys[order].tolist()]
                 
-                for key, value in op['breakdown'].items():
-                    if not key.endswith('_count') and isinstance(value, (int, float)) and value > 0:
-                        time_ms = value / 1_000_000
-                        relative_pct = (value / total_breakdown_time * 100) if total_breakdown_time > 0 else 0
-                        breakdown_data.append({
-                            'Operation': key.replace('_', ' ').title(),
-                            'Time (ms)': f"{time_ms:.3f}",
-                            'Relative %': f"{relative_pct:.1f}%"
-                        })
-                
-                if breakdown_data and len(breakdown_data) > 1:
-                    breakdown_data.sort(key=lambda x: float(x['Time (ms)']), reverse=True)
-                    
-                    # Create breakdown chart
-                    ops = [item['Operation'] for item in breakdown_data[:8]]
-                    times = [float(item['Time (ms)']) for item in breakdown_data[:8]]
-                    
-                    if len(times) > 1:
-                        fig = go.Figure(go.Bar(
-                            y=ops[::-1], 
-                            x=times[::-1], 
-                            orientation='h',
-                            marker_color=times[::-1], 
-                            marker_colorscale='Viridis'
-                        ))
-                        fig.update_layout(
-                            title=f"Query Breakdown: {op['type']}", 
-                            xaxis_title="Time (ms)", 
-                            height=max(200, len(ops) * 30),
-                            showlegend=False
-                        )
-                        st.plotly_chart(fig, use_container_width=True)
-                    
-                    # Show breakdown table with button toggle (with unique prefix)
-                    button_key = f"query_breakdown_{unique_prefix}_{level}_{i}"
-                    if button_key not in st.session_state:
-                        st.session_state[button_key] = False
-                    
-                    col_btn, col_info = st.columns([3, 1])
-                    with col_btn:
-                        if st.button(f"📋 {'Hide' if st.session_state[button_key] else 'Show'} Query Breakdown Table ({len(breakdown_data)} operations)", key=button_key + "_btn"):
-                            st.session_state[button_key] = not st.session_state[button_key]
-                    
-                    if st.session_state[button_key]:
-                        st.dataframe(breakdown_data, use_container_width=True, hide_index=True)
-            
-            # Add visual separator for tree levels
-            if level < 3:
-                st.markdown("---")
+                charts.append((f"Query Breakdown: {op['type']}", ops[:8], times_ms[:8]))
+                breakdown_table['Query'].extend([op['type']] * len(ops))
+                breakdown_table['Operation'].extend(ops)
+                breakdown_table['Time (ms)'].extend(times_ms.tolist())
+                breakdown_table['Relative %'].extend(relative_pcts.tolist())
         
-        # Recursively display children (limit depth to avoid too much nesting)
+        # Limit depth to avoid too much nesting
         if op['children'] and level < 3:
-            display_operation_tree(op['children'], level + 1, total_time, unique_prefix)
+            stack.extend((child, level + 1) for child in reversed(op['children']))
+    
+    st.markdown(
+        '<table style="width: 100%;"><thead><tr><th>Operation</th><th>Self Time</th>'
+        '<th>Total Time</th><th>% of Query</th></tr></thead><tbody>'
+        f'{rows.getvalue()}</tbody></table>',
+        unsafe_allow_html=True
+    )
+    
+    if charts:
+        breakdown_fig = memo_chart(
+            ChartLabel("query_breakdown", (unique_prefix,), "Query Breakdown"),
+            create_query_breakdown_chart, tuple(charts)
+        )
+        st.plotly_chart(breakdown_fig, use_container_width=True, config=BREAKDOWN_CHART_CONFIG, key=f"query_breakdown_chart_{unique_prefix}")
+    
+    # A single switch for every breakdown table of this tree
+    breakdown_count = len(breakdown_table['Operation'])
+    if breakdown_count:
+        if st.toggle(f"📋 Show Query Breakdown Tables ({breakdown_count} operations)", key=f"query_breakdowns_{unique_prefix}"):
+            st.dataframe(pa.table(breakdown_table), use_container_width=True, hide_index=True, column_config=TABLE_COLUMN_CONFIG)
+
+def toggle_shard(shard_id):
+    """Open a shard's details, closing whichever shard was open before"""
+    if st.session_state.get('expanded_shard_id') == shard_id:
+        st.session_state.expanded_shard_id = None
+    else:
+        st.session_state.expanded_shard_id = shard_id
 
 # Query Profile Tree Section 
-if hasattr(st.session_state, 'result') and shards:
+@st.fragment
+def render_profile_tree(shards, shards_by_time):
+    """Render the per-index shard tree; its widgets only rerun this fragment"""
     st.subheader("🌳 Query Profile Tree")
     st.write("*Hierarchical view of query execution*")
     
-    # Group shards by index
+    # Raw shards by id, for the operation trees built from the original query data
+    original_shards = st.session_state.result.get('profile', {}).get('shards', [])
+    original_by_id = {orig_shard.get('id', ''): orig_shard for orig_shard in original_shards}
+    
+    # Group shards by index, totalling index time as we go
     index_groups = {}
     for shard in shards:
-        index_name = shard['index']
-        if index_name not in index_groups:
-            index_groups[index_name] = []
-        index_groups[index_name].append(shard)
+        group = index_groups.setdefault(shard['index'], {'shards': [], 'total_time': 0.0})
+        group['total_time'] += shard['total_query_ms']
+    # Filling groups from the time-sorted list keeps each index's shards slowest first
+    for shard in shards_by_time:
+        index_groups[shard['index']]['shards'].append(shard)
     
     # Display each index
-    for index_idx, (index_name, index_shards) in enumerate(index_groups.items()):
+    for index_idx, (index_name, group) in enumerate(index_groups.items()):
         st.write(f"### 📂 Index: **{index_name}**")
-        
-        # Calculate total index time
-        total_index_time = sum(
-            sum(q['time_ms'] for search in shard['searches'] for q in search['queries'])
-            for shard in index_shards
-        )
+        index_shards = group['shards']
+        total_index_time = group['total_time']
         
         if total_index_time > 0:
             st.write(f"**Cumulative time:** {total_index_time:.2f}ms")
         
-        # Display each shard in the index (make each shard collapsible and collapsed by default)
-        for shard_idx, shard in enumerate(sorted(index_shards, key=lambda s: sum(q['time_ms'] for search in s['searches'] for q in search['queries']), reverse=True)):
-            shard_time = sum(q['time_ms'] for search in shard['searches'] for q in search['queries'])
+        # Large indices are paged so a rerun only sends one window of shard headers
+        page_start = 0
+        if len(index_shards) > SHARD_PAGE_SIZE:
+            page_start = st.selectbox(
+                "Shards",
+                range(0, len(index_shards), SHARD_PAGE_SIZE),
+                format_func=lambda start: f"{start + 1}-{min(start + SHARD_PAGE_SIZE, len(index_shards))} of {len(index_shards)} (slowest first)",
+                key=f"shard_page_{index_idx}"
+            )
+        
+        # Display each shard in the index (collapsed by default)
+        for shard_idx, shard in enumerate(index_shards[page_start:page_start + SHARD_PAGE_SIZE], start=page_start):
+            shard_time = shard['total_query_ms']
             shard_percentage = (shard_time / total_index_time * 100) if total_index_time > 0 else 0
-            shard_color = get_color_for_percentage(shard_percentage)
+            badge_class = get_badge_class(shard_percentage)
+            
+            # Expander bodies run even when collapsed, so only the single open shard
+            # builds its charts and tables; the rest render as a header button
+            is_open = st.session_state.get('expanded_shard_id') == shard['id']
+            st.button(
+                f"{'▼' if is_open else '▶'} 🔍 Shard [{shard['id']}] - {shard_time:.2f}ms ({shard_percentage:.1f}%)", 
+                key=f"open_{shard['id']}",
+                on_click=toggle_shard,
+                args=(shard['id'],)
+            )
+            if not is_open:
+                continue
             
-            # Make each shard collapsible (collapsed by default)
-            with st.expander(
-                f"🔍 Shard [{shard['id']}] - {shard_time:.2f}ms ({shard_percentage:.1f}%)", 
-                expanded=False
-            ):
+            with st.container(border=True):
                 # Shard time badge
-                st.markdown(f"""
-                <div style="
-                    background-color: {shard_color}; 
-                    color: white; 
-                    padding: 8px 16px; 
-                    border-radius: 8px; 
-                    text-align: center; 
-                    font-weight: bold;
-                    margin-bottom: 16px;
-                ">
-                    Shard Time: {shard_time:.2f}ms ({shard_percentage:.1f}%)
-                </div>
-                """, unsafe_allow_html=True)
+                st.markdown(
+                    f'<div class="badge shard-badge {badge_class}">'
+                    f'Shard Time: {shard_time:.2f}ms ({shard_percentage:.1f}%)</div>',
+                    unsafe_allow_html=True
+                )
                 
-                # Process searches for this shard
+                # Process searches for this shard against the raw profile data
+                original_searches = original_by_id.get(shard['id'], {}).get('searches', [])
                 for search_idx, search in enumerate(shard['searches']):
-                    if search['queries']:
-                        # Build operation tree from raw search data
-                        if hasattr(st.session_state, 'result'):
-                            original_shards = st.session_state.result.get('profile', {}).get('shards', [])
-                            
-                            # Find the matching original shard data
-                            original_shard = None
-                            for orig_shard in original_shards:
-                                if shard['id'] in orig_shard.get('id', ''):
-                                    original_shard = orig_shard
-                                    break
-                            
-                            if original_shard and 'searches' in original_shard:
-                                for orig_search_idx, orig_search in enumerate(original_shard['searches']):
-                                    if orig_search_idx == search_idx and 'query' in orig_search:
-                                        # Calculate total search time for percentage calculations
-                                        total_search_time = sum(q['time_ms'] for q in search['queries'])
-                                        
-                                        # Build and display operation tree with unique prefix
-                                        operations = build_operation_tree(orig_search['query'])
-                                        
-                                        if operations:
-                                            st.write("**Query Operations:**")
-                                            # Create unique prefix for this shard/search combination
-                                            unique_prefix = f"{index_idx}_{shard_idx}_{search_idx}_{orig_search_idx}"
-                                            display_operation_tree(operations, total_time=total_search_time, unique_prefix=unique_prefix)
-                                        
-                                        # Show rewrite time if available
-                                        if 'rewrite_time' in orig_search and orig_search['rewrite_time'] > 0:
-                                            rewrite_ms = orig_search['rewrite_time'] / 1_000_000
-                                            st.info(f"🔄 **Rewrite Time:** {rewrite_ms:.3f}ms")
+                    if not search['queries'] or search_idx >= len(original_searches):
+                        continue
+                    orig_search = original_searches[search_idx]
+                    if 'query' not in orig_search:
+                        continue
+                    
+                    # Calculate total search time for percentage calculations
+                    total_search_time = sum(q['time_ms'] for q in search['queries'])
+                    
+                    # Build and display operation tree with unique prefix
+                    operations = load_operation_tree(
+                        st.session_state.get('result_key'), shard['id'], search_idx, orig_search['query']
+                    )
+                    
+                    if operations:
+                        st.markdown("---\n\n**Query Operations:**" if search_idx else "**Query Operations:**")
+                        # Create unique prefix for this shard/search combination
+                        unique_prefix = f"{index_idx}_{shard_idx}_{search_idx}"
+                        display_operation_tree(operations, total_time=total_search_time, unique_prefix=unique_prefix)
+                    
+                    # Show rewrite time if available
+                    if 'rewrite_time' in orig_search and orig_search['rewrite_time'] > 0:
+                        rewrite_ms = orig_search['rewrite_time'] / 1_000_000
+                        st.info(f"🔄 **Rewrite Time:** {rewrite_ms:.3f}ms")
+                
+                # Collector and aggregation tables are built once per response
+                tables = load_breakdown_tables(st.session_state.get('result_key'), shard['id'], shard)
                 
-                # Show collectors information (with charts and button-toggle tables)
+                # Show collectors information (chart plus one selectable collector table)
                 if any(search.get('collectors') for search in shard['searches']):
-                    st.write("**Collectors:**")
+                    # Section separators ride along with the following heading instead of being elements
+                    st.markdown("---\n\n**Collectors:**")
                     all_collectors = []
                     for search in shard['searches']:
                         for collector in search.get('collectors', []):
@@ -675,114 +1039,65 @@ if hasattr(st.session_state, 'result') and shards:
                     
                     # Create collector chart
                     if len(all_collectors) > 1:
-                        collector_fig = create_collector_chart(all_collectors, "Collector Performance")
+                        collector_fig = memo_chart(
+                            ChartLabel("collectors", (shard['id'],), "Collector Performance"),
+                            create_collector_chart, all_collectors, "Collector Performance"
+                        )
                         if collector_fig:
-                            st.plotly_chart(collector_fig, use_container_width=True)
+                            st.plotly_chart(collector_fig, use_container_width=True, key=f"collectors_{shard['id']}")
                     
-                    # Show collector details in containers
-                    for collector_idx, search in enumerate(shard['searches']):
-                        for coll_idx, collector in enumerate(search.get('collectors', [])):
-                            with st.container():
-                                st.write(f"📋 **{collector['name']}** ({collector['time_ms']:.2f}ms)")
-                                if collector.get('reason'):
-                                    st.write(f"   Reason: {collector['reason']}")
-                                
-                                if collector.get('children'):
-                                    # Prepare collector table data
-                                    child_data = []
-                                    for child in collector['children']:
-                                        child_data.append({
-                                            'Name': child['name'],
-                                            'Reason': child.get('reason', ''),
-                                            'Time (ms)': f"{child['time_ms']:.3f}"
-                                        })
-                                    
-                                    if child_data:
-                                        # Button toggle for collector children (with unique key)
-                                        collector_button_key = f"collector_{index_idx}_{shard_idx}_{collector_idx}_{coll_idx}"
-                                        if collector_button_key not in st.session_state:
-                                            st.session_state[collector_button_key] = False
-                                        
-                                        if st.button(f"📋 {'Hide' if st.session_state[collector_button_key] else 'Show'} Collector Details ({len(child_data)} child collectors)", key=collector_button_key + "_btn"):
-                                            st.session_state[collector_button_key] = not st.session_state[collector_button_key]
-                                        
-                                        if st.session_state[collector_button_key]:
-                                            st.dataframe(child_data, use_container_width=True, hide_index=True)
-                                
-                                st.markdown("---")
+                    # Selecting a collector row shows its child collectors
+                    st.caption("📋 Select a collector to show its child collectors")
+                    selection = st.dataframe(
+                        tables['collectors'], 
+                        use_container_width=True, 
+                        hide_index=True, 
+                        column_config=TABLE_COLUMN_CONFIG,
+                        on_select="rerun",
+                        selection_mode="single-row",
+                        key=f"collector_table_{shard['id']}"
+                    )
+                    if selection.selection.rows:
+                        row = selection.selection.rows[0]
+                        child_data = tables['collector_children'][row]
+                        if child_data is not None:
+                            st.write(f"**{tables['collector_names'][row]}** child collectors:")
+                            st.dataframe(child_data, use_container_width=True, hide_index=True, column_config=TABLE_COLUMN_CONFIG)
+                        else:
+                            st.write(f"**{tables['collector_names'][row]}** has no child collectors")
                 
-                # Show aggregations if any (with charts and button-toggle tables)
+                # Show aggregations if any (with charts and toggled tables)
                 if shard['aggregations']:
-                    st.write("**Aggregations:**")
                     for agg_idx, agg in enumerate(shard['aggregations']):
                         with st.container():
-                            st.write(f"📊 **{agg['type']}** ({agg['time_ms']:.2f}ms)")
+                            # Separator, section heading, title and description go out as one markdown element
+                            md_parts = ["---", f"📊 **{agg['type']}** ({agg['time_ms']:.2f}ms)"]
+                            if agg_idx == 0:
+                                md_parts.insert(1, "**Aggregations:**")
                             if agg['description']:
-                                st.code(agg['description'])
+                                md_parts.append(f"```\n{agg['description']}\n```")
+                            st.markdown("\n\n".join(md_parts))
+                            
+                            # Breakdown chart and table, from the ops / times_ms arrays built at parse time
+                            breakdown_data = tables['aggregations'].get(agg_idx)
                             
-                            # Handle breakdown with charts
-                            if agg['breakdown']:
-                                if isinstance(agg['breakdown'], list):
-                                    # Create chart for list format
-                                    breakdown_fig = create_breakdown_chart_from_list(
-                                        agg['breakdown'], 
-                                        f"Aggregation Breakdown: {agg['type']}"
-                                    )
-                                    if breakdown_fig:
-                                        st.plotly_chart(breakdown_fig, use_container_width=True)
-                                    
-                                    # Show breakdown table with button toggle (with unique key)
-                                    breakdown_data = []
-                                    for breakdown_item in agg['breakdown']:
-                                        if isinstance(breakdown_item, dict) and breakdown_item.get('time_ms', 0) > 0:
-                                            breakdown_data.append({
-                                                'Operation': breakdown_item.get('operation', '').replace('_', ' ').title(),
-                                                'Time (ms)': f"{breakdown_item['time_ms']:.3f}"
-                                            })
-                                    
-                                    if breakdown_data:
-                                        breakdown_data.sort(key=lambda x: float(x['Time (ms)']), reverse=True)
-                                        # Button toggle for aggregation breakdown
-                                        agg_button_key = f"agg_list_{index_idx}_{shard_idx}_{agg_idx}"
-                                        if agg_button_key not in st.session_state:
-                                            st.session_state[agg_button_key] = False
-                                        
-                                        if st.button(f"📋 {'Hide' if st.session_state[agg_button_key] else 'Show'} Aggregation Breakdown Table ({len(breakdown_data)} operations)", key=agg_button_key + "_btn"):
-                                            st.session_state[agg_button_key] = not st.session_state[agg_button_key]
-                                        
-                                        if st.session_state[agg_button_key]:
-                                            st.dataframe(breakdown_data, use_container_width=True, hide_index=True)
-                                        
-                                elif isinstance(agg['breakdown'], dict):
-                                    # Create chart for dict format
-                                    breakdown_fig = create_breakdown_chart_from_dict(
-                                        agg['breakdown'], 
-                                        f"Aggregation Breakdown: {agg['type']}"
-                                    )
-                                    if breakdown_fig:
-                                        st.plotly_chart(breakdown_fig, use_container_width=True)
-                                    
-                                    # Show breakdown table with button toggle (with unique key)
-                                    breakdown_data = []
-                                    for key, value in agg['breakdown'].items():
-                                        if not key.endswith('_count') and isinstance(value, (int, float)) and value > 0:
-                                            time_ms = value / 1_000_000 if value > 1000 else value
-                                            breakdown_data.append({
-                                                'Operation': key.replace('_', ' ').title(),
-                                                'Time (ms)': f"{time_ms:.3f}"
-                                            })
-                                    
-                                    if breakdown_data:
-                                        breakdown_data.sort(key=lambda x: float(x['Time (ms)']), reverse=True)
-                                        # Button toggle for aggregation breakdown
-                                        agg_button_key = f"agg_dict_{index_idx}_{shard_idx}_{agg_idx}"
-                                        if agg_button_key not in st.session_state:
-                                            st.session_state[agg_button_key] = False
-                                        
-                                        if st.button(f"📋 {'Hide' if st.session_state[agg_button_key] else 'Show'} Aggregation Breakdown Table ({len(breakdown_data)} operations)", key=agg_button_key + "_btn"):
-                                            st.session_state[agg_button_key] = not st.session_state[agg_button_key]
-                                        
-                                        if st.session_state[agg_button_key]:
-                                            st.dataframe(breakdown_data, use_container_width=True, hide_index=True)
+                            # Create chart unless fewer than two operations took any time
+                            if breakdown_data is not None and breakdown_data.num_rows > 1:
+                                title = f"Aggregation Breakdown: {agg['type']}"
+                                breakdown_fig = memo_chart(
+                                    ChartLabel("aggregation", (shard['id'], agg_idx), title),
+                                    create_breakdown_chart, agg['breakdown'], title
+                                )
+                                if breakdown_fig:
+                                    st.plotly_chart(breakdown_fig, use_container_width=True, config=BREAKDOWN_CHART_CONFIG, key=f"agg_breakdown_{shard['id']}_{agg_idx}")
                             
-                            st.markdown("---")
\ No newline at end of file
+                            # Show breakdown table behind a toggle (with unique key)
+                            if breakdown_data is not None:
+                                if st.toggle(f"📋 Show Aggregation Breakdown Table ({breakdown_data.num_rows} operations)", key=f"agg_table_{index_idx}_{shard_idx}_{agg_idx}"):
+                                    st.dataframe(breakdown_data, use_container_width=True, hide_index=True, column_config=TABLE_COLUMN_CONFIG)
+
+
+if result is not None and shards:
+    # Outside the fragment, so fragment reruns keep the stylesheet without resending it
+    st.markdown(_BADGE_CSS, unsafe_allow_html=True)
+    render_profile_tree(shards, shards_by_time)